@@ -0,0 +1,145 @@
+import os
+import sys
+import sqlite3
+import datetime
+import subprocess
+
+import pytest
+
+import weather_db
+import weather_web
+
+START = datetime.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def cursor():
+    '''One day of data saved every 10 seconds, with constant readings'''
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    cursor.execute(weather_db.query_create_db)
+    cursor.execute(weather_db.query_create_index)
+    for table in weather_db.rollup_tables:
+        cursor.execute(weather_db.query_create_rollup.format(table=table))
+    timestamps = [(START + datetime.timedelta(seconds=10 * i)).strftime('%Y-%m-%d %H:%M:%S') for i in range(8640)]
+    cursor.executemany('INSERT INTO weather_data VALUES (?, 225, 10, 20, 50, 100, 200, 60, 10100, 450)',
+                       [(t, ) for t in timestamps])
+    conn.commit()
+    weather_db.update_rollups(cursor, conn, since=START)
+    yield cursor
+    conn.close()
+
+
+@pytest.fixture
+def summary_conn():
+    '''Summary table with a single row, opened like connect_db does'''
+    conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+    cursor = conn.cursor()
+    cursor.execute(weather_db.query_create_summary)
+    cursor.execute('INSERT INTO weather_summary (timestamp, wind_degree, wind_mph, wind_mph_max, temp_fahrenheit, '
+                   'temp_fahrenheit_max, temp_fahrenheit_min, humidity_percent, pressure_tenth_hpa) '
+                   "VALUES ('2024-01-01 12:00:00', 225, 10, 20, 66, 70, 50, 57, 10119)")
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_plan_range_raw_when_sparse_enough():
+    end = START + datetime.timedelta(hours=1)
+    assert weather_web.plan_range(START, end, 360) == ('raw', None)
+    assert weather_web.plan_range(START, end, 1000) == ('raw', None)
+
+
+def test_plan_range_bucket_size_and_source():
+    end = START + datetime.timedelta(hours=24)
+    assert weather_web.plan_range(START, end, 3600) == ('average', 24)
+    assert weather_web.plan_range(START, end, 1440) == ('minute', 60)
+    assert weather_web.plan_range(START, end, 24) == ('hour', 3600)
+    assert weather_web.plan_range(START, end, 0) == ('hour', 86400)
+
+
+def test_read_range_raw(cursor):
+    end = START + datetime.timedelta(minutes=30)
+    source, data = weather_web.read_range(cursor, ('wind_mph', ), START, end, 500)
+    assert source == 'raw'
+    assert list(data) == ['timestamp', 'wind_mph']
+    assert len(data['timestamp']) == 181
+    assert data['timestamp'][0] == '2024-01-01 00:00:00'
+
+
+@pytest.mark.parametrize('points, source', [(5000, 'average'), (500, 'minute'), (20, 'hour')])
+def test_read_range_bucket_count(cursor, points, source):
+    end = START + datetime.timedelta(hours=24)
+    read_source, data = weather_web.read_range(cursor, ('temp_fahrenheit', ), START, end, points)
+    assert read_source == source
+    assert len(data['timestamp']) == pytest.approx(points, rel=0.05)
+    assert set(data['temp_fahrenheit']) == {10.0}
+
+
+def test_read_range_metric_units(cursor):
+    end = START + datetime.timedelta(minutes=1)
+    _, data = weather_web.read_range(cursor, weather_web.SENSOR_COLUMNS, START, end, 500)
+    assert data['wind_degree'][0] == 225
+    assert data['wind_mph'][0] == pytest.approx(16.09344)
+    assert data['temp_fahrenheit'][0] == 10.0
+    assert data['rain_hour_cent_inch'][0] == pytest.approx(25.4)
+    assert data['pressure_tenth_hpa'][0] == pytest.approx(1010.0)
+    assert data['cpu_temp_x10_celsius'][0] == pytest.approx(45.0)
+
+
+def test_parse_sensors_is_normalised():
+    assert weather_web.parse_sensors(None) == weather_web.SENSOR_COLUMNS
+    assert weather_web.parse_sensors('wind_mph,temp_fahrenheit,wind_mph') == ('wind_mph', 'temp_fahrenheit')
+    with pytest.raises(ValueError):
+        weather_web.parse_sensors('wind_mph,not_a_sensor')
+
+
+def test_parse_timestamp():
+    default = datetime.datetime(2000, 1, 1)
+    assert weather_web.parse_timestamp('', default) == default
+    assert weather_web.parse_timestamp('2024-03-01 12:30:15.1234', None) == datetime.datetime(2024, 3, 1, 12, 30, 15)
+    assert weather_web.parse_timestamp('2024-03-01T01:00:00+01:00', None) == datetime.datetime(2024, 3, 1)
+    assert weather_web.parse_timestamp('2024-03-01T00:00:00Z', None) == datetime.datetime(2024, 3, 1)
+    with pytest.raises(ValueError):
+        weather_web.parse_timestamp('yesterday', None)
+
+
+@pytest.mark.parametrize('query', ['start=yesterday', 'end=0001-01-01', 'points=many', 'points=0', 'points=-3',
+                                   'start=2024-01-02&end=2024-01-01', 'sensors=not_a_sensor'])
+def test_api_range_bad_input(query):
+    response = weather_web.app.test_client().get(f'/api/range?{query}')
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_import_does_not_load_pandas_or_plotly():
+    code = 'import sys, weather_web; print(any(m in sys.modules for m in ("pandas", "plotly", "numpy", "matplotlib")))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == 'False'
+
+
+def test_read_summary(summary_conn):
+    summary = weather_web.read_summary(summary_conn.cursor())
+    assert len(summary) == 1
+    row = summary[0]
+    assert row['timestamp'] == datetime.datetime(2024, 1, 1, 12)
+    assert row['wind_degree'] == 225
+    assert row['wind_mph'] == pytest.approx(16.09344)
+    assert row['temp_fahrenheit'] == 19.0
+    assert row['temp_fahrenheit_min'] == 10.0
+    assert row['humidity_percent'] == 57
+    assert row['pressure_tenth_hpa'] == pytest.approx(1011.9)
+
+
+def test_index_renders_summary(summary_conn, monkeypatch):
+    monkeypatch.setattr(weather_web, 'connect_db', lambda db_name: (summary_conn, summary_conn.cursor()))
+    response = weather_web.app.test_client().get('/')
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert '2024-01-01 12:00:00' in page
+    assert '<td>19.0</td>' in page
+    assert '<td>16.1</td>' in page
+    assert 'Max: 21.0' in page
+    assert 'Min: 10.0' in page
+    assert '<td>1011.9</td>' in page
@@ -22,6 +22,47 @@ query_create_db = '''
             cpu_temp_x10_celsius INTEGER
         );
     '''
+# Plots and the range API always filter on the timestamp, without an index every query reads the whole table
+query_create_index = '''
+        CREATE INDEX IF NOT EXISTS weather_data_timestamp ON weather_data (timestamp);
+    '''
+# Averages of weather_data over each minute and each hour, so that plots of long periods don't read every row. The
+# period format works both in python and in sqlite strftime
+rollup_tables = {
+    'weather_data_minute': ('%Y-%m-%d %H:%M:00', datetime.timedelta(minutes=1)),
+    'weather_data_hourly': ('%Y-%m-%d %H:00:00', datetime.timedelta(hours=1)),
+}
+query_create_rollup = '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            timestamp TIMESTAMP PRIMARY KEY,
+            wind_degree REAL,
+            wind_mph REAL,
+            gust_mph REAL,
+            temp_fahrenheit REAL,
+            rain_hour_cent_inch REAL,
+            rain_24h_cent_inch REAL,
+            humidity_percent REAL,
+            pressure_tenth_hpa REAL,
+            cpu_temp_x10_celsius REAL
+        );
+    '''
+query_update_rollup = '''
+        INSERT OR REPLACE INTO {table}
+        SELECT
+            strftime('{period}', timestamp) AS period_start,
+            AVG(wind_degree),
+            AVG(wind_mph),
+            AVG(gust_mph),
+            AVG(temp_fahrenheit),
+            AVG(rain_hour_cent_inch),
+            AVG(rain_24h_cent_inch),
+            AVG(humidity_percent),
+            AVG(pressure_tenth_hpa),
+            AVG(cpu_temp_x10_celsius)
+        FROM weather_data
+        WHERE timestamp >= ?
+        GROUP BY period_start
+    '''
 query_create_summary = '''        
         CREATE TABLE IF NOT EXISTS weather_summary (
             timestamp TIMESTAMP,
@@ -106,8 +147,16 @@ def init_db(db_name):
 
         cursor = conn.cursor()
         cursor.execute(query_create_db)
+        cursor.execute(query_create_index)
         cursor.execute(query_create_summary)
+        for table in rollup_tables:
+            cursor.execute(query_create_rollup.format(table=table))
         conn.commit()
+        # Fill the rollup tables if they have just been created on an existing database
+        cursor.execute('SELECT COUNT(*) FROM weather_data_hourly')
+        if cursor.fetchone()[0] == 0:
+            logging.info('Computing the rollup tables from all the data...')
+            update_rollups(cursor, conn, since=datetime.datetime(1970, 1, 1))
         # Check that the weather summary has an entry
         cursor.execute('SELECT COUNT(*) FROM weather_summary')
         n_entries = cursor.fetchone()[0]
@@ -201,6 +250,18 @@ def update_summary(cursor, data, summary):
 
     return summary
 
+def update_rollups(cursor, conn, since=None):
+    '''Recompute the rollup averages for all the data after `since` (UTC). By default only the current and the previous
+    period of each table are recomputed, which covers the rows written since the last update'''
+    now = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        for table, (period, length) in rollup_tables.items():
+            table_since = now - length if since is None else since
+            cursor.execute(query_update_rollup.format(table=table, period=period), (table_since.strftime(period), ))
+        conn.commit()
+    except Exception as error:
+        logging.error(f"Error while updating the rollup tables:\n{error}")
+
 def reset_summary(cursor, conn):
     try:
         cursor.execute('DELETE FROM weather_summary ORDER BY timestamp DESC LIMIT 1')
@@ -315,6 +376,7 @@ if __name__ == '__main__':
         # Save it in the database
         current_count = write_db(cursor, data, current_count)
         last_data_entry = time.time()
+        update_rollups(cursor, conn)
 
         # Update the summary
         summary = update_summary(cursor, data, summary)
@@ -1,20 +1,45 @@
 #!/usr/bin/python
 
-import base64
+import os
+import time
 import sqlite3
 import logging
-import numpy as np
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import matplotlib.dates as md
-import matplotlib.pyplot as plt
-from io import BytesIO
-from flask import Flask, render_template, request
+import datetime
+import re
+import resource
+import functools
+import threading
+# pandas and plotly are slow to import on the Pi, they are only imported in the functions that draw the plots
+from flask import Flask, g, jsonify, render_template, request
 from flask_compress import Compress
 
 app = Flask(__name__)
 compress = Compress(app)
+# The cold-start measurements are logged at INFO. Flask adds its own handler to app.logger when the root logger has none,
+# so they are also shown when running in a WSGI server that does not configure logging
+app.logger.setLevel(logging.INFO)
+
+DB_NAME = '/home/pi152/weather/data/current_data.db'  # Name of current database
+
+# Columns of weather_data that can be requested through the range API
+SENSOR_COLUMNS = ('wind_degree', 'wind_mph', 'gust_mph', 'temp_fahrenheit', 'rain_hour_cent_inch',
+                  'rain_24h_cent_inch', 'humidity_percent', 'pressure_tenth_hpa', 'cpu_temp_x10_celsius')
+RAW_INTERVAL_SECONDS = 10  # weather_db.py saves a row every 10 seconds
+# Rollup tables kept up to date by weather_db.py, as (source, table, seconds averaged in each row), coarsest first
+ROLLUP_SOURCES = (('hour', 'weather_data_hourly', 3600), ('minute', 'weather_data_minute', 60))
+SOURCE_TABLES = {'raw': 'weather_data', 'average': 'weather_data'}
+SOURCE_TABLES.update({source: table for source, table, _ in ROLLUP_SOURCES})
+MAX_RANGE_POINTS = 5000
+PLOT_POINTS = 3600  # Values per sensor in the plots, both for the selected period and when zooming in
+QUERY_CACHE_SIZE = 64  # Range queries kept in memory, well below the 128 statements sqlite3 caches per connection
+
+# The plots and the range API share a single connection so that sqlite can reuse its compiled statements between
+# requests
+range_lock = threading.Lock()
+range_conn = None
+
+# Each worker logs its startup time and memory after serving its first request
+first_request_logged = False
 
 def connect_db(db_name):
     '''Initialise the database with default table'''
@@ -33,6 +58,98 @@ def read_db(cursor, query):
     all_data = cursor.fetchall()
     return all_data
 
+def get_range_cursor(db_name):
+    '''Return a cursor on the connection shared by the plots and the range API, opening it the first time. Only use
+    it while holding range_lock'''
+    global range_conn
+    if range_conn is None:
+        range_conn = sqlite3.connect(db_name, check_same_thread=False)
+    return range_conn.cursor()
+
+@functools.lru_cache(maxsize=QUERY_CACHE_SIZE)
+def range_query(sensors, source):
+    '''Build the SQL to read a set of sensors between two timestamps. The SQL text only depends on the sensors and on
+    the source, so the same string is returned for every request and sqlite can reuse the prepared statement.
+    `sensors` must be in SENSOR_COLUMNS order without duplicates (see parse_sensors), so each set has a single entry.
+    Parameters are bound as (start, end) for raw data and (start, end, bucket_seconds) for the other sources.'''
+    if source != 'raw':
+        columns = ',\n    '.join(f'AVG({s}) AS {s}' for s in sensors)
+        group_by = "GROUP BY\n    CAST(strftime('%s', timestamp) AS INTEGER) / ?"
+    else:
+        columns = ',\n    '.join(sensors)
+        group_by = ''
+
+    return f"""
+SELECT
+    strftime('%Y-%m-%d %H:%M:%S', timestamp) as timestamp,
+    {columns}
+FROM
+    {SOURCE_TABLES[source]}
+WHERE
+    timestamp BETWEEN ? AND ?
+{group_by}
+ORDER BY
+    timestamp;
+"""
+
+def plan_range(start, end, points):
+    '''Choose where to read the data from. If the raw rows are already sparse enough they are returned as they are,
+    otherwise they are averaged in buckets so that roughly `points` values come back. Buckets are averaged from the
+    coarsest rollup table that still fits in a bucket, so long periods only read a few rows per bucket'''
+    span = (end - start).total_seconds()
+    bucket_seconds = int(span // max(points, 1))
+    if bucket_seconds <= RAW_INTERVAL_SECONDS:
+        return 'raw', None
+    for source, _, rollup_seconds in ROLLUP_SOURCES:
+        if bucket_seconds >= rollup_seconds:
+            return source, bucket_seconds
+    return 'average', bucket_seconds
+
+def read_range(cursor, sensors, start, end, points):
+    '''Read the selected sensors between start and end, with at most about `points` values per sensor'''
+    source, bucket_seconds = plan_range(start, end, points)
+    # Same format as CURRENT_TIMESTAMP, so that timestamps can be compared as strings
+    params = [start.isoformat(sep=' ', timespec='seconds'), end.isoformat(sep=' ', timespec='seconds')]
+    if source != 'raw':
+        params.append(bucket_seconds)
+
+    cursor.execute(range_query(sensors, source), params)
+    rows = cursor.fetchall()
+
+    data = {'timestamp': [row[0] for row in rows]}
+    for i, sensor in enumerate(sensors, start=1):
+        data[sensor] = [metric_value(sensor, row[i]) for row in rows]
+    return source, data
+
+def utc_now():
+    '''Current time as a naive UTC datetime, like the timestamps saved by CURRENT_TIMESTAMP'''
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+def parse_sensors(value):
+    '''Parse a comma separated list of sensors from the query string. The result always follows the order of
+    SENSOR_COLUMNS and has no duplicates, so the same set of sensors always maps to the same query'''
+    if not value:
+        return SENSOR_COLUMNS
+    requested = set(value.split(','))
+    unknown = requested.difference(SENSOR_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown sensors: {", ".join(sorted(unknown))}')
+    return tuple(s for s in SENSOR_COLUMNS if s in requested)
+
+def parse_timestamp(value, default):
+    '''Parse a timestamp from the query string as a naive UTC datetime, like the ones stored by CURRENT_TIMESTAMP.
+    Plotly sends ranges like "2024-01-01 12:30:15.1234", the fraction of second is dropped as data is only saved every
+    few seconds. Timestamps with an offset are converted to UTC'''
+    if not value:
+        return default
+    value = re.sub(r'\.\d+', '', value.replace('T', ' '))
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    timestamp = datetime.datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
 def reset_min_max(cursor, conn):
     # Query to get the latest data from weather_data table
     latest_query = '''
@@ -108,24 +225,39 @@ def reset_min_max(cursor, conn):
     # Commit changes and close connection
     conn.commit()
 
-def convert_to_metric(df):
-    for column in df.columns:
-        if 'mph' in column:
-            df[column] *= 1.609344  # mph to kmh
-        if 'fahrenheit' in column:
-            df[column] -= 32
-            df[column] *= 5/9  # deg F to deg C
-            df[column] = round(df[column] * 2) / 2  # Round off to 0.5
-        if 'cent_inch' in column:
-            df[column] *= 25.4 * 0.01  # cent inch to mm
-        if 'x10_celsius' in column:
-            df[column] /= 10  # cpu temp from x10 C to C
-        if 'tenth_hpa' in column:
-            df[column] /= 10  # Pressure from tenth hpa to hpa
-    return df
+@functools.lru_cache(maxsize=None)
+def metric_converter(column):
+    '''Return the function converting a value of `column` to metric units. The conversion is worked out once per
+    column name, so converting a row is only a few arithmetic operations'''
+    if 'mph' in column:
+        return lambda value: value * 1.609344  # mph to kmh
+    if 'fahrenheit' in column:
+        return lambda value: round((value - 32) * 5/9 * 2) / 2  # deg F to deg C, rounded off to 0.5
+    if 'cent_inch' in column:
+        return lambda value: value * 25.4 * 0.01  # cent inch to mm
+    if 'x10_celsius' in column:
+        return lambda value: value / 10  # cpu temp from x10 C to C
+    if 'tenth_hpa' in column:
+        return lambda value: value / 10  # Pressure from tenth hpa to hpa
+    return lambda value: value
+
+def metric_value(column, value):
+    '''Convert a single value to metric, leaving missing values as None'''
+    if value is None:
+        return None
+    return metric_converter(column)(value)
+
+def read_summary(cursor):
+    '''Read the summary table as a list of dicts, converted to metric'''
+    cursor.execute('SELECT * FROM weather_summary')
+    column_names = [col[0] for col in cursor.description]
+    return [{column: metric_value(column, value) for column, value in zip(column_names, row)}
+            for row in cursor.fetchall()]
 
     
 def generate_plot(df, target, label):
+    import plotly.graph_objects as go
+
     # Create a Plotly figure
     fig = go.Figure(data=go.Scatter(x=df['timestamp'], y=df[target], marker_color=df[target], mode='lines+markers',
                                     line=dict(color='black')))
@@ -136,6 +268,8 @@ def generate_plot(df, target, label):
     return plot_json
 
 def generate_plot_bar(df, target, label):
+    import plotly.graph_objects as go
+
     # Create a Plotly figure
     bar_width = [df.index[i + 1] - df.index[i] for i in range(len(df.index) - 1)]
 
@@ -158,68 +292,69 @@ def generate_plot_bar(df, target, label):
 
     return plot_json
     
+def process_age():
+    '''Seconds since this process was started, read from /proc (Linux only)'''
+    try:
+        with open('/proc/self/stat') as stat_file:
+            # starttime is the 22nd field, in clock ticks after boot. Skip the command name, it can contain spaces
+            start_ticks = int(stat_file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime_file:
+            uptime = float(uptime_file.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError) as error:
+        logging.error(f"Error while reading the process start time:\n{error}")
+        return None
+
+@app.before_request
+def start_request_timer():
+    g.request_tic = time.perf_counter()
+
+@app.after_request
+def log_first_request(response):
+    '''Log how long the worker took to serve its first request (cold start) and how much memory it needs after it'''
+    global first_request_logged
+    if not first_request_logged:
+        first_request_logged = True
+        request_time = time.perf_counter() - g.request_tic
+        age = process_age()
+        age = 'unknown' if age is None else f'{age:.2f}'
+        max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+        app.logger.info(f'Worker {os.getpid()} served its first request ({request.path}) in {request_time:.3f} s, '
+                        f'{age} s after starting, max RSS {max_rss_mb:.1f} MB')
+    return response
+
 @app.route('/plots')
 def plots():
+    import pandas as pd
+
     # Read the 'period' parameter from the query string
     period = request.args.get('period')
     bars = request.args.get('bars')
 
     plot_func = generate_plot_bar if bars else generate_plot
 
-    db_name = f'/home/pi152/weather/data/current_data.db'  # Name of current database
-    # Read all data
-    conn, cursor = connect_db(db_name)
-
-    # save every 10 seconds
-    # Points in hour = 360
-    # Points in a day = 8640, subsample 24
-    # Points in a week = 60480, subsample 168
-    # Points in a month = 259200, subsample 720
-    # Points in 3 months = 777600, subsample 2160
-
-    # Read selected period
+    # Read selected period. Data is saved every 10 seconds, plan_range averages it so that each plot has about
+    # PLOT_POINTS values, the same resolution that the zoom requests to /api/range start from
+    end = utc_now()
     period = 'day' if period is None else period
     if period == 'hour':
-        show_every_n = 1
-        where = f"timestamp BETWEEN datetime('now', '-1 Hour') AND datetime('now', 'localtime')"
+        start = end - datetime.timedelta(hours=1)
     elif period == 'day':
-        show_every_n = 24
-        where = f"timestamp BETWEEN datetime('now', '-24 Hours') AND datetime('now', 'localtime')"
+        start = end - datetime.timedelta(hours=24)
     elif period == 'week':
-        show_every_n = 168
-        where = f"timestamp BETWEEN datetime('now', '-7 days') AND datetime('now', 'localtime')"
+        start = end - datetime.timedelta(days=7)
     elif period == 'month':
-        show_every_n = 720
-        where = f"timestamp BETWEEN datetime('now', '-30 days') AND datetime('now', 'localtime')"
+        start = end - datetime.timedelta(days=30)
     else:
-        show_every_n = 2160
-        where = f"0 = 0"
+        start = None
 
-
-    query = f"""
-SELECT 
-    strftime('%Y-%m-%d %H:%M:%S', timestamp) as timestamp,
-    AVG(wind_degree) AS wind_degree,
-    AVG(wind_mph) AS wind_mph,
-    AVG(gust_mph) AS gust_mph,
-    AVG(temp_fahrenheit) AS temp_fahrenheit,
-    AVG(rain_hour_cent_inch) AS rain_hour_cent_inch,
-    AVG(rain_24h_cent_inch) AS rain_24h_cent_inch,
-    AVG(humidity_percent) AS humidity_percent,
-    AVG(pressure_tenth_hpa) AS pressure_tenth_hpa,
-    AVG(cpu_temp_x10_celsius) AS cpu_temp_x10_celsius
-FROM 
-    weather_data
-WHERE
-    {where}
-GROUP BY 
-    CAST(strftime('%s', timestamp) AS INTEGER) / {show_every_n}
-ORDER BY
-    timestamp;
-"""
-    df = pd.read_sql_query(query, conn)
-#    df = pd.read_sql_query(f"SELECT * FROM weather_data {cond}", conn)
-    df = convert_to_metric(df)
+    with range_lock:
+        cursor = get_range_cursor(DB_NAME)
+        if start is None:
+            cursor.execute('SELECT MIN(timestamp) FROM weather_data')
+            start = parse_timestamp(cursor.fetchone()[0], end - datetime.timedelta(hours=24))
+        _, data = read_range(cursor, SENSOR_COLUMNS, start, end, PLOT_POINTS)
+    df = pd.DataFrame(data)
 
     plot_temperature = plot_func(df, 'temp_fahrenheit', 'Temperature')
     plot_cpu = plot_func(df, 'cpu_temp_x10_celsius', 'CPU Temperature')
@@ -234,14 +369,40 @@ ORDER BY
                            plot_pressure=plot_pressure, plot_windspeed=plot_windspeed,
                            plot_winddirection=plot_winddirection, plot_windgust=plot_windgust, plot_rain_hour=plot_rain_hour,
                            plot_rain_day=plot_rain_day,
-                           period=period)
+                           period=period, bars=bars, plot_points=PLOT_POINTS)
+
+
+@app.route('/api/range')
+def api_range():
+    '''Return the selected sensors between start and end (UTC), downsampled to about `points` values'''
+
+    try:
+        end = parse_timestamp(request.args.get('end'), utc_now())
+        start = parse_timestamp(request.args.get('start'), end - datetime.timedelta(hours=24))
+        points = min(int(request.args.get('points', PLOT_POINTS)), MAX_RANGE_POINTS)
+    except (ValueError, OverflowError) as error:
+        return jsonify(error=f'Invalid range parameters: {error}'), 400
+
+    try:
+        sensors = parse_sensors(request.args.get('sensors'))
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    if start >= end:
+        return jsonify(error='start must be before end'), 400
+    if points < 1:
+        return jsonify(error='points must be at least 1'), 400
+
+    with range_lock:
+        cursor = get_range_cursor(DB_NAME)
+        source, data = read_range(cursor, sensors, start, end, points)
+
+    return jsonify(source=source, data=data)
 
 
 @app.route('/')
 def index():
-    db_name = f'/home/pi152/weather/data/current_data.db'  # Name of current database
     # Read all data
-    conn, cursor = connect_db(db_name)
+    conn, cursor = connect_db(DB_NAME)
 
     # Reset max if requested
     reset_max = request.args.get('reset_max')
@@ -253,11 +414,7 @@ def index():
         reset_min_max(cursor, conn)
 
     # Generate summary data
-    summary_data = pd.read_sql_query(f"SELECT * FROM weather_summary", conn)
-    summary_data = convert_to_metric(summary_data)
-
-    # query = 'SELECT * FROM weather_summary'
-    # summary_data = read_db(cursor, query)
+    summary_data = read_summary(cursor)
 
     return render_template('index.html', summary_data=summary_data)
 
@@ -266,5 +423,4 @@ if __name__ == '__main__':
     FORMAT = '%(asctime)s %(message)s'
     logging.basicConfig(filename='/home/pi152/weather/web.log', encoding='utf-8', level=logging.DEBUG, format=FORMAT)
 
-
     app.run(host='0.0.0.0', debug=True)